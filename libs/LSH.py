@@ -1,21 +1,46 @@
+from functools import lru_cache
+
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.metrics import pairwise_distances
 import scipy.sparse as sp
 
+try:
+    from libs._minhash_numba import minhash_csc
+except ImportError:
+    minhash_csc = None
+
 
 # Prime Number Helper
+@lru_cache(maxsize=None)
 def next_prime(n):
     def is_prime(k):
+        # Deterministic Miller-Rabin: these witnesses are exact for k < 3.3 * 10**24
+        witnesses = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
         if k < 2:
             return False
-        for i in range(2, int(k**0.5) + 1):
-            if k % i == 0:
+        for p in witnesses:
+            if k % p == 0:
+                return k == p
+
+        d, s = k - 1, 0
+        while d % 2 == 0:
+            d //= 2
+            s += 1
+
+        for a in witnesses:
+            x = pow(a, d, k)
+            if x == 1 or x == k - 1:
+                continue
+            for _ in range(s - 1):
+                x = pow(x, 2, k)
+                if x == k - 1:
+                    break
+            else:
                 return False
         return True
-    
+
     prime = n + 1
     while not is_prime(prime):
         prime += 1
@@ -35,19 +60,44 @@ def create_characteristic_matrix(ratings, all_movies, user_movies):
 
     return characteristic_matrix
 
+# Create Sparse (CSC) Characteristic Matrix
+def create_sparse_characteristic_matrix(user_movies, movie_to_index, n_movies, n_users):
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    for user in range(n_users):
+        indptr[user + 1] = indptr[user] + len(user_movies[user + 1])
+
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    for user in range(n_users):
+        indices[indptr[user]:indptr[user + 1]] = [movie_to_index[movie] for movie in user_movies[user + 1]]
+
+    data = np.ones(len(indices), dtype=np.int8)
+    return sp.csc_matrix((data, indices, indptr), shape=(n_movies, n_users))
+
 # Generate MinHash Signatures
 def generate_minhash_signatures(characteristic_matrix, n_hashes):
-    n_movies, n_users = characteristic_matrix.shape
-    hash_params = [(np.random.randint(1, n_movies), np.random.randint(0, n_movies)) for _ in range(n_hashes)]
+    return generate_minhash_signatures_csc(sp.csc_matrix(characteristic_matrix), n_hashes)
+
+# Generate MinHash Signatures from a CSC Matrix
+def generate_minhash_signatures_csc(csc, n_hashes):
+    n_movies, n_users = csc.shape
+    a = np.random.randint(1, n_movies, size=n_hashes, dtype=np.int64)
+    b = np.random.randint(0, n_movies, size=n_hashes, dtype=np.int64)
     mod_prime = next_prime(n_movies)
 
-    signature_matrix = np.full((n_hashes, n_users), np.inf)
+    dtype = np.uint32 if mod_prime < 2**32 else np.int64
+    signature_matrix = np.full((n_hashes, n_users), np.iinfo(dtype).max, dtype=dtype)
+
+    if minhash_csc is not None:
+        minhash_csc(csc.indptr.astype(np.int64), csc.indices.astype(np.int64), a, b, mod_prime, signature_matrix)
+        return signature_matrix
 
-    for row in range(n_movies):
-        hashes = [(a * row + b) % mod_prime for a, b in hash_params]
-        for col in range(n_users):
-            if characteristic_matrix[row, col] == 1:
-                signature_matrix[:, col] = np.minimum(signature_matrix[:, col], hashes)
+    rows = np.arange(n_movies, dtype=np.int64)
+    hashes = ((np.multiply.outer(a, rows) + b[:, None]) % mod_prime).astype(dtype)
+
+    for user in range(n_users):
+        user_rows = csc.indices[csc.indptr[user]:csc.indptr[user + 1]]
+        if len(user_rows):
+            signature_matrix[:, user] = hashes[:, user_rows].min(axis=1)
 
     return signature_matrix
 
@@ -56,19 +106,25 @@ def lsh_bucket_creation(signature_matrix, n_bands):
     n_hashes, n_users = signature_matrix.shape
     rows_per_band = n_hashes // n_bands
     buckets = {}
+    user_to_buckets = [[] for _ in range(n_users)]
 
     for band_idx in range(n_bands):
         start_row = band_idx * rows_per_band
         end_row = start_row + rows_per_band
 
-        band_hashes = tuple(map(tuple, signature_matrix[start_row:end_row, :].T))
+        band = signature_matrix[start_row:end_row, :].T
+        _, bucket_ids = np.unique(band, axis=0, return_inverse=True)
+        bucket_ids = bucket_ids.ravel()
 
-        for user_idx, band_hash in enumerate(band_hashes):
-            if band_hash not in buckets:
-                buckets[band_hash] = []
-            buckets[band_hash].append(user_idx)
+        order = np.argsort(bucket_ids, kind="stable")
+        boundaries = np.flatnonzero(np.diff(bucket_ids[order])) + 1
+        for users in np.split(order, boundaries):
+            bucket_key = (band_idx, int(bucket_ids[users[0]]))
+            buckets[bucket_key] = users.tolist()
+            for user_idx in buckets[bucket_key]:
+                user_to_buckets[user_idx].append(bucket_key)
 
-    return buckets
+    return buckets, user_to_buckets
 
 # Debugging Buckets
 def debug_lsh_buckets(buckets):
@@ -77,62 +133,75 @@ def debug_lsh_buckets(buckets):
         print(f"Bucket {hash(bucket)}: Users: {users}")
 
 # Recommend Movies Using LSH
-def recommend_movies_lsh(target_user_idx, user_movies, buckets, ratings, top_n=5):
+def recommend_movies_lsh(target_user_idx, user_movies, buckets, user_to_buckets, rating_matrix, top_n=5):
     similar_users = set()
-    for users in buckets.values():
-        if target_user_idx in users:
-            similar_users.update(users)
+    for bucket_key in user_to_buckets[target_user_idx]:
+        similar_users.update(buckets[bucket_key])
     similar_users.discard(target_user_idx)
 
     if not similar_users:
         print(f"No similar users found for User {target_user_idx + 1}.")
         return []
 
-    similar_users_movies = pd.DataFrame(
-        [
-            (user, movie, ratings.loc[(ratings["userId"] == user + 1) & (ratings["movieId"] == movie), "rating"].mean())
-            for user in similar_users
-            for movie in user_movies[user + 1]
-        ],
-        columns=["userId", "movieId", "avg_rating"]
-    )
+    # Mean rating of each movie over the similar users who rated it
+    candidate_ratings = rating_matrix[sorted(similar_users)]
+    rating_sums = np.asarray(candidate_ratings.sum(axis=0)).ravel()
+    rating_counts = candidate_ratings.getnnz(axis=0)
 
-    similar_users_movies = similar_users_movies.groupby("movieId")["avg_rating"].mean().reset_index()
-    similar_users_movies = similar_users_movies.sort_values(by="avg_rating", ascending=False)
+    avg_ratings = np.full(rating_sums.shape, -np.inf)
+    rated = rating_counts > 0
+    avg_ratings[rated] = rating_sums[rated] / rating_counts[rated]
+    avg_ratings[list(user_movies[target_user_idx + 1])] = -np.inf
+
+    top_n = min(top_n, int(np.isfinite(avg_ratings).sum()))
+    if top_n == 0:
+        return []
 
-    recommended_movies = similar_users_movies[~similar_users_movies["movieId"].isin(user_movies[target_user_idx + 1])]
+    top_movies = np.argpartition(-avg_ratings, top_n - 1)[:top_n]
+    top_movies = top_movies[np.argsort(-avg_ratings[top_movies], kind="stable")]
 
-    return recommended_movies.head(top_n)["movieId"].tolist()
+    return top_movies.tolist()
 
 def locality_sensitive_hashing_workflow(ratings, n_hashes=100, n_bands=20, top_n=5):
     all_movies = set(ratings["movieId"].unique())
     user_movies = ratings.groupby("userId")["movieId"].apply(set).to_dict()
+    movie_to_index = {movie: i for i, movie in enumerate(all_movies)}
 
-    characteristic_matrix = create_characteristic_matrix(ratings, all_movies, user_movies)
-    signature_matrix = generate_minhash_signatures(characteristic_matrix, n_hashes)
-    buckets = lsh_bucket_creation(signature_matrix, n_bands)
+    characteristic_matrix = create_sparse_characteristic_matrix(
+        user_movies, movie_to_index, len(all_movies), len(user_movies)
+    )
+    signature_matrix = generate_minhash_signatures_csc(characteristic_matrix, n_hashes)
+    buckets, user_to_buckets = lsh_bucket_creation(signature_matrix, n_bands)
 
     debug_lsh_buckets(buckets)
 
+    # Users x movies rating matrix; (userId, movieId) pairs are unique in MovieLens, so each
+    # movie's mean over similar users equals the mean of their per-user average ratings
+    rating_matrix = sp.csr_matrix(
+        (ratings["rating"].to_numpy(), (ratings["userId"].to_numpy() - 1, ratings["movieId"].to_numpy()))
+    )
+
     for user_idx in range(len(user_movies)):
         print(f"\nGenerating recommendations for User {user_idx + 1}...")
         recommended_movies = recommend_movies_lsh(
             target_user_idx=user_idx,
             user_movies=user_movies,
             buckets=buckets,
-            ratings=ratings,
+            user_to_buckets=user_to_buckets,
+            rating_matrix=rating_matrix,
             top_n=top_n,
         )
         print(f"Recommended movies for User {user_idx + 1}: {recommended_movies}")
 
 def plot_probability_curve(n=100, band_values=[5, 10, 20, 25, 50]):
     s = np.linspace(0, 1, 100)
+    bands = np.asarray(band_values, dtype=int)
+    rows = n // bands
+    probability = 1 - (1 - s[:, None]**rows)**bands
 
     plt.figure(figsize=(10, 6))
-    for b in band_values:
-        r = n // b
-        probability = 1 - (1 - s**r)**b
-        plt.plot(s, probability, label=f"$b = {b}, r = {r}$")
+    for column, (b, r) in enumerate(zip(bands, rows)):
+        plt.plot(s, probability[:, column], label=f"$b = {b}, r = {r}$")
 
     plt.title(f"Probability for $n = {n}$ hash functions and different values of $b$")
     plt.xlabel("Similarity $s$")
@@ -0,0 +1,136 @@
+import numpy as np
+from numba import njit, prange
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+@njit(inline="always")
+def mod_mersenne(v):
+    """v % MERSENNE_PRIME for 0 <= v < 2**63, using shift-and-add folding instead of a division."""
+    v = (v & MERSENNE_PRIME) + (v >> 31)
+    v = (v & MERSENNE_PRIME) + (v >> 31)
+    return v - MERSENNE_PRIME if v >= MERSENNE_PRIME else v
+
+
+@njit(inline="always")
+def mod_reciprocal(v, p, inv_p):
+    """v % p for 0 <= v < 2**53, using a multiplication by the float reciprocal 1 / p instead of a division."""
+    r = v - np.int64(v * inv_p) * p
+    r = r + p if r < 0 else r
+    return r - p if r >= p else r
+
+
+@njit(parallel=True, cache=True, boundscheck=False, error_model="numpy")
+def minhash_csc(indptr, indices, a, b, p, sig):
+    """
+    Compute MinHash signatures straight from the CSC arrays of a characteristic matrix.
+
+    The hash (a * row + b) % p is evaluated on the fly, so the n_hashes x n_movies
+    hash table is never materialized, and users are processed in parallel.
+    Each user's signature is accumulated in a contiguous buffer, one movie at a time
+    over all hash functions, so the inner loop is a branchless min that LLVM turns
+    into SIMD code; for p < 2**26 the modulo is also replaced by mod_reciprocal.
+
+    Args:
+        indptr: CSC column pointers (int64), length n_users + 1.
+        indices: CSC row indices (int64).
+        a, b: Hash coefficients (int64), length n_hashes, below p.
+        p: Prime modulus, larger than every row index.
+        sig: Signature matrix of dimensions (n_hashes, n_users), pre-filled with the
+            largest value of its dtype; updated in place.
+    """
+    n_hashes, n_users = sig.shape
+    # a * row + b < p**2 < 2**52 keeps the float reciprocal exact enough
+    reciprocal = p < (1 << 26)
+    inv_p = 1.0 / p
+    for u in prange(n_users):
+        m = np.empty(n_hashes, dtype=np.int64)
+        for h in range(n_hashes):
+            m[h] = sig[h, u]
+        for k in range(indptr[u], indptr[u + 1]):
+            r = indices[k]
+            if reciprocal:
+                for h in range(n_hashes):
+                    m[h] = min(m[h], mod_reciprocal(a[h] * r + b[h], p, inv_p))
+            else:
+                for h in range(n_hashes):
+                    m[h] = min(m[h], (a[h] * r + b[h]) % p)
+        for h in range(n_hashes):
+            sig[h, u] = m[h]
+
+
+@njit("void(int64[::1], int64[::1], int64[::1], int64, int64[::1])",
+      nogil=True, cache=True, boundscheck=False, error_model="numpy")
+def minhash_linear(a, b, x, prime, out):
+    """
+    Compute the MinHash signature of one set with linear hash functions (a * x + b) % prime.
+
+    Compiled eagerly for C-contiguous int64 arrays, without the GIL so that signatures
+    of different users can be computed on parallel threads, and with NumPy's error
+    model so the modulo carries no per-element zero-division check.
+
+    Args:
+        a, b: Hash coefficients (int64), length n_hash_functions.
+        x: Elements of the set (int64).
+        prime: Prime modulus; MERSENNE_PRIME is reduced without a division.
+        out: Signature (int64), pre-filled with an upper bound; updated in place.
+    """
+    mersenne = prime == MERSENNE_PRIME
+    for i in range(a.shape[0]):
+        m = out[i]
+        ai = a[i]
+        bi = b[i]
+        if mersenne:
+            for j in range(x.shape[0]):
+                v = mod_mersenne(ai * x[j] + bi)
+                if v < m:
+                    m = v
+        else:
+            for j in range(x.shape[0]):
+                v = (ai * x[j] + bi) % prime
+                if v < m:
+                    m = v
+        out[i] = m
+
+
+@njit(parallel=True, cache=True, boundscheck=False, error_model="numpy")
+def lsh_assign(indptr, movies, a, b, prime, mask, rows_per_band, band_seeds, fnv_prime, out):
+    """
+    Compute the LSH bucket keys of many sets in one pass, without materializing their signatures.
+
+    For each set and each band, the rows_per_band MinHash values (a * x + b) % prime of
+    the band are computed, truncated with mask, and folded straight into a 64-bit FNV-1a
+    hash started from the band's seed, matching LSH.create_bucket_hash on the signatures.
+    The FNV-1a parameters are passed in by libs.locality_sensitive_hashing, which defines them.
+    Sets are processed in parallel.
+
+    Args:
+        indptr: Set pointers (int64), length n_sets + 1: set u is movies[indptr[u]:indptr[u + 1]].
+        movies: Elements of all the sets (int64), concatenated.
+        a, b: Hash coefficients (int64), at least num_bands * rows_per_band of them.
+        prime: Prime modulus; MERSENNE_PRIME is reduced without a division.
+            It is also the value of the signature of an empty set.
+        mask: Bit mask applied to every MinHash value (b-bit MinHash).
+        rows_per_band: Number of hash values in each band.
+        band_seeds: FNV-1a state after hashing the band index (uint64), length num_bands.
+        fnv_prime: FNV-1a multiplier (uint64).
+        out: Bucket keys (uint64) of dimensions (n_sets, num_bands); filled in place.
+    """
+    n_sets, num_bands = out.shape
+    mersenne = prime == MERSENNE_PRIME
+    for u in prange(n_sets):
+        start, stop = indptr[u], indptr[u + 1]
+        for band in range(num_bands):
+            h = band_seeds[band]
+            for i in range(band * rows_per_band, (band + 1) * rows_per_band):
+                m = prime
+                ai = a[i]
+                bi = b[i]
+                if mersenne:
+                    for j in range(start, stop):
+                        m = min(m, mod_mersenne(ai * movies[j] + bi))
+                else:
+                    for j in range(start, stop):
+                        m = min(m, (ai * movies[j] + bi) % prime)
+                h = (h ^ np.uint64(m & mask)) * fnv_prime
+            out[u, band] = h
@@ -1,7 +1,44 @@
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import col, avg, count, to_date, year, explode, split
+from pyspark.sql.types import StructType, StructField, IntegerType, DoubleType, StringType, TimestampType
 import pandas as pd
 
+# Explicit schemas of the MovieLens 20M CSV files, so Spark does not scan them twice to infer types
+SCHEMAS = {
+    "tag": StructType([
+        StructField("userId", IntegerType()),
+        StructField("movieId", IntegerType()),
+        StructField("tag", StringType()),
+        StructField("timestamp", TimestampType()),
+    ]),
+    "rating": StructType([
+        StructField("userId", IntegerType()),
+        StructField("movieId", IntegerType()),
+        StructField("rating", DoubleType()),
+        StructField("timestamp", TimestampType()),
+    ]),
+    "movie": StructType([
+        StructField("movieId", IntegerType()),
+        StructField("title", StringType()),
+        StructField("genres", StringType()),
+    ]),
+    "link": StructType([
+        StructField("movieId", IntegerType()),
+        StructField("imdbId", IntegerType()),
+        StructField("tmdbId", IntegerType()),
+    ]),
+    "genome_scores": StructType([
+        StructField("movieId", IntegerType()),
+        StructField("tagId", IntegerType()),
+        StructField("relevance", DoubleType()),
+    ]),
+    "genome_tags": StructType([
+        StructField("tagId", IntegerType()),
+        StructField("tag", StringType()),
+    ]),
+}
+
 def initialize_spark(app_name="MovieLens Analysis"):
     """
     Initialize the Spark session.
@@ -12,12 +49,12 @@ def load_data(spark, path):
     """
     Load all datasets into Spark DataFrames.
     """
-    tag_df = spark.read.csv(f"{path}/tag.csv", header=True, inferSchema=True)
-    rating_df = spark.read.csv(f"{path}/rating.csv", header=True, inferSchema=True)
-    movie_df = spark.read.csv(f"{path}/movie.csv", header=True, inferSchema=True)
-    link_df = spark.read.csv(f"{path}/link.csv", header=True, inferSchema=True)
-    genome_scores_df = spark.read.csv(f"{path}/genome_scores.csv", header=True, inferSchema=True)
-    genome_tags_df = spark.read.csv(f"{path}/genome_tags.csv", header=True, inferSchema=True)
+    tag_df = spark.read.csv(f"{path}/tag.csv", header=True, schema=SCHEMAS["tag"])
+    rating_df = spark.read.csv(f"{path}/rating.csv", header=True, schema=SCHEMAS["rating"])
+    movie_df = spark.read.csv(f"{path}/movie.csv", header=True, schema=SCHEMAS["movie"])
+    link_df = spark.read.csv(f"{path}/link.csv", header=True, schema=SCHEMAS["link"])
+    genome_scores_df = spark.read.csv(f"{path}/genome_scores.csv", header=True, schema=SCHEMAS["genome_scores"])
+    genome_tags_df = spark.read.csv(f"{path}/genome_tags.csv", header=True, schema=SCHEMAS["genome_tags"])
     
     return tag_df, rating_df, movie_df, link_df, genome_scores_df, genome_tags_df
 
@@ -36,6 +73,9 @@ def inspect_data(df, num_rows=5, convert_to_pandas=False):
 def preprocess_movies_ratings(movie_df, rating_df):
     """
     Preprocess the movies and ratings data by joining and extracting genres and year.
+    The result is persisted because it feeds several aggregations. Nothing here
+    releases it: the aggregations are lazy, so the caller should call
+    .unpersist() on it only after their results have been collected or saved.
     """
     # Join movies and ratings
     movies_ratings_df = movie_df.join(rating_df, "movieId")
@@ -46,7 +86,8 @@ def preprocess_movies_ratings(movie_df, rating_df):
     # Explode genres into multiple rows
     movies_ratings_df = movies_ratings_df.withColumn("genre", explode(split(col("genres"), "\\|")))
     
-    return movies_ratings_df
+    # Keep the joined and exploded rows around instead of recomputing them for every aggregation
+    return movies_ratings_df.persist(StorageLevel.MEMORY_AND_DISK)
 
 def calculate_avg_ratings_by_genre(movies_ratings_df):
     """
@@ -68,9 +109,19 @@ def calculate_ratings_by_year(movies_ratings_df):
 
 def save_to_csv(dataframe, path):
     """
-    Save the Spark DataFrame to a CSV file.
+    Save the Spark DataFrame to a CSV directory (one part file per partition).
+    """
+    dataframe.write.csv(path, header=True)
+
+def save_to_parquet(dataframe, path, partition_by=None):
+    """
+    Save the Spark DataFrame as Parquet, overwriting any previous output.
+    - partition_by: Optional list of columns to partition the output by.
     """
-    dataframe.coalesce(1).write.csv(path, header=True)
+    writer = dataframe.write.mode("overwrite")
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(path)
 
 def merge_datasets(tag_df, rating_df, movie_df, link_df, genome_scores_df, genome_tags_df):
     # Rename ambiguous columns
@@ -19,7 +19,7 @@ class KMeansVisualizer:
         self.data = data
         self.centroids_history = centroids_history
         self.labels_history = labels_history
-        self.iteration_data = []
+        self.df_iterations = None
         
         # Prepares data for visualization
         self._prepare_visualization_data()
@@ -28,34 +28,38 @@ class KMeansVisualizer:
         """
         Prepares the data for each iteration for interactive visualization.
         """
-        # Loop through each iteration of centroids and labels
-        for iteration, (centroids, labels) in enumerate(zip(self.centroids_history, self.labels_history)):
-            # For each data point, store its feature values, cluster assignment, and centroid position
-            for i, point in enumerate(self.data):
-                self.iteration_data.append({
-                    'Iteration': iteration + 1,  # Iteration number
-                    'Feature1': point[0],         # Feature 1 (e.g., x-coordinate in PCA space)
-                    'Feature2': point[1],         # Feature 2 (e.g., y-coordinate in PCA space)
-                    'Cluster': labels[i],         # Cluster assignment
-                    'Centroid_X': centroids[labels[i]][0],  # X position of the assigned centroid
-                    'Centroid_Y': centroids[labels[i]][1]   # Y position of the assigned centroid
-                })
+        data = np.asarray(self.data)
+        frames = []
+
+        # Build one column-oriented DataFrame per iteration instead of one dict per point
+        for iteration, (centroids, labels) in enumerate(zip(self.centroids_history, self.labels_history), start=1):
+            centroids = np.asarray(centroids)
+            labels = np.asarray(labels)
+            frames.append(pd.DataFrame({
+                'Iteration': iteration,                 # Iteration number
+                'Feature1': data[:, 0],                 # Feature 1 (e.g., x-coordinate in PCA space)
+                'Feature2': data[:, 1],                 # Feature 2 (e.g., y-coordinate in PCA space)
+                'Cluster': labels,                      # Cluster assignment
+                'Centroid_X': centroids[labels, 0],     # X position of the assigned centroid
+                'Centroid_Y': centroids[labels, 1]      # Y position of the assigned centroid
+            }))
+
+        self.df_iterations = pd.concat(frames, ignore_index=True)
     
     def create_visualization(self):
         """
         Creates the interactive visualization of the evolution of the clusters.
         """
-        # Convert the iteration data into a DataFrame for easier handling
-        df_iterations = pd.DataFrame(self.iteration_data)
+        df_iterations = self.df_iterations
         
         # Define a color map for the clusters
         color_map = px.colors.qualitative.Plotly
         
         # Prepare frames for animation
         frames = []
-        for iteration in df_iterations['Iteration'].unique():
-            # Filter the data for the current iteration
-            df_frame = df_iterations[df_iterations['Iteration'] == iteration]
+        for iteration, rows in df_iterations.groupby('Iteration').indices.items():
+            # Select the rows of the current iteration
+            df_frame = df_iterations.iloc[rows]
             
             # Scatter plot of the data points
             scatter = go.Scatter(
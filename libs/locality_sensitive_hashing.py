@@ -1,4 +1,48 @@
 import random
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+
+from libs.minhash_similarity import MinHash
+
+try:
+    from libs._minhash_numba import lsh_assign
+except ImportError:
+    lsh_assign = None
+
+# 64-bit FNV-1a parameters, also passed to libs._minhash_numba.lsh_assign
+FNV_OFFSET = 14695981039346656037
+FNV_PRIME = 1099511628211
+
+
+def _band_seeds(band_indices):
+    """FNV-1a state after hashing the band index, one per band (uint64 arithmetic wraps around)."""
+    return (np.uint64(FNV_OFFSET) ^ np.asarray(band_indices, dtype=np.uint64)) * np.uint64(FNV_PRIME)
+
+
+def _fnv_band_keys(band_seeds, band_signatures):
+    """
+    Bucket keys of many bands at once: 64-bit FNV-1a over the values of each row, starting from its band seed.
+    
+    Args:
+        band_seeds (np.ndarray): Seeds from _band_seeds, one per row or a single one for all rows.
+        band_signatures (np.ndarray): Band values, shape (n_rows, rows_per_band).
+    
+    Returns:
+        list: One bucket key per row
+    """
+    band_signatures = np.asarray(band_signatures).astype(np.uint64)
+    bucket_keys = np.empty(len(band_signatures), dtype=np.uint64)
+    bucket_keys[:] = band_seeds
+    
+    # One FNV-1a step per column, for all rows at once
+    for column in band_signatures.T:
+        bucket_keys ^= column
+        bucket_keys *= np.uint64(FNV_PRIME)
+    return bucket_keys.tolist()
+
+
 class LSH:
     def __init__(self, num_bands: int, rows_per_band: int):
         """
@@ -12,25 +56,39 @@ class LSH:
         self.rows_per_band = rows_per_band
         
         # Dictionary to store buckets with similar signature bands
-        self.buckets = {}
+        self.buckets = defaultdict(list)
+        
+        # List of bucket keys to sample from in view_buckets, built lazily
+        self._bucket_keys = None
+        
+        # Stacked signatures and their row of each user, kept by build_buckets for query_with_similarity
+        self._signature_matrix = None
+        self._user_rows = None
+        
+        # Slice of the signature covered by each band, computed once
+        self._band_slices = tuple(
+            slice(band_idx * rows_per_band, (band_idx + 1) * rows_per_band) for band_idx in range(num_bands)
+        )
+        
+        # Hash seed of each band, computed once
+        self._band_seeds = _band_seeds(np.arange(num_bands))
     
     def create_bucket_hash(self, band_idx, band_signature):
         """
-        Create a hash that generates a readable code.
+        Create the 64-bit bucket key of a band.
         
-        Returns:
-            str: A unique hash code
-        """
-        # Combine band index and signature values
-        hash_code = band_idx
-        for val in band_signature:
-            hash_code = (hash_code * 31 + val) % (2**63 - 1)
+        The band values are hashed with FNV-1a, the same hash the fused kernel used by
+        build_buckets_from_sets computes, so keys only depend on the values and not on their dtype.
+        The band index is mixed in so that equal bands in different positions do not share a bucket.
         
-        # Ensure the hash is positive and limit to 6 digits
-        bucket_code = hash_code % 1000000
+        Args:
+            band_idx (int): Index of the band.
+            band_signature (list): Values of the band.
         
-        # Format as LSH-NNNNNN
-        return f"LSH-{bucket_code:06d}"
+        Returns:
+            int: The bucket key
+        """
+        return _fnv_band_keys(self._band_seeds[band_idx], np.asarray(band_signature)[None, :])[0]
     
     def build_buckets(self, signatures: dict):
         """
@@ -46,25 +104,72 @@ class LSH:
                 None
         """
         # Reset buckets to ensure clean slate
-        self.buckets = {}
-        
-        # Iterate through each user's signature
-        for user_id, signature in signatures.items():
-            # Divide signature into bands
-            for band_idx in range(self.num_bands):
-                # Calculate start and end indices for the current band
-                start = band_idx * self.rows_per_band
-                end_index = start + self.rows_per_band
-                
-                # Extract band signature and convert to tuple for hashing
-                band_signature = tuple(signature[start:end_index])
-                
-                # Create bucket key using custom hash function
-                bucket_key = self.create_bucket_hash(band_idx, band_signature)
-                
-                # Add user ID to the corresponding bucket
-                if bucket_key not in self.buckets:
-                    self.buckets[bucket_key] = []
+        self.buckets = defaultdict(list)
+        self._bucket_keys = None
+        self._signature_matrix = None
+        self._user_rows = None
+        if not signatures:
+            return
+        
+        # Stack all signatures into one (n_users, n_hashes) array with a fixed dtype
+        user_ids = list(signatures.keys())
+        signature_matrix = np.stack([np.asarray(signature) for signature in signatures.values()])
+        
+        # Keep the stacked signatures to score candidates in query_with_similarity
+        self._signature_matrix = signature_matrix
+        self._user_rows = {user_id: row for row, user_id in enumerate(user_ids)}
+        
+        # Divide signatures into bands, hashing one band of all users at once
+        for band_idx, band_slice in enumerate(self._band_slices):
+            bucket_keys = _fnv_band_keys(self._band_seeds[band_idx], signature_matrix[:, band_slice])
+            
+            for user_id, bucket_key in zip(user_ids, bucket_keys):
+                # Add user ID to the bucket keyed by the hash of the band values
+                self.buckets[bucket_key].append(user_id)
+    
+    def build_buckets_from_sets(self, user_movies: dict, minhash):
+        """
+        Build hash buckets straight from the movie sets of the users.
+        
+        With linear MinHash and Numba available, signatures, band hashes and bucket keys are
+        computed by one fused kernel and the signatures are never materialized, so 
+        query_with_similarity is not available afterwards. Otherwise the signatures are 
+        created with minhash and passed to build_buckets. Either way the buckets are the same.
+        
+        Args:
+            user_movies (dict): Dictionary with user IDs as keys and sets of movie IDs as values.
+            minhash (MinHash): MinHash object with at least num_bands * rows_per_band hash functions.
+        Returns:
+                None
+        """
+        if minhash.n_hash_functions < self.num_bands * self.rows_per_band:
+            raise ValueError("minhash must have at least num_bands * rows_per_band hash functions")
+        
+        if lsh_assign is None or minhash.type_function != 'linear':
+            self.build_buckets({user_id: minhash.create_signature(movies) for user_id, movies in user_movies.items()})
+            return
+        
+        # Reset buckets to ensure clean slate
+        self.buckets = defaultdict(list)
+        self._bucket_keys = None
+        self._signature_matrix = None
+        self._user_rows = None
+        if not user_movies:
+            return
+        
+        # Concatenate all movie sets: user u owns movies[indptr[u]:indptr[u + 1]]
+        user_ids = list(user_movies.keys())
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum([len(movies) for movies in user_movies.values()], out=indptr[1:])
+        movies = np.fromiter(chain.from_iterable(user_movies.values()), dtype=np.int64, count=indptr[-1])
+        
+        # Bucket keys of every user and band, shape (n_users, num_bands)
+        bucket_keys = np.empty((len(user_ids), self.num_bands), dtype=np.uint64)
+        lsh_assign(indptr, movies, minhash.a, minhash.b, minhash.prime, (1 << minhash.bbit) - 1,
+                   self.rows_per_band, self._band_seeds, np.uint64(FNV_PRIME), bucket_keys)
+        
+        for band_keys in bucket_keys.T.tolist():
+            for user_id, bucket_key in zip(user_ids, band_keys):
                 self.buckets[bucket_key].append(user_id)
     
     def query(self, query_signature: list, query_user_id: int):
@@ -79,32 +184,52 @@ class LSH:
             query_user_id (int): ID of the user making the query
         
         Returns:
-            list: List of candidate user IDs similar to the query user
+            list: Sorted list of candidate user IDs similar to the query user
         """
-        # Set to store unique candidate user IDs
-        candidates = set()
+        # Bucket keys of all bands in one pass: one row per band
+        n_rows = self.num_bands * self.rows_per_band
+        bands = np.asarray(query_signature)[:n_rows].reshape(self.num_bands, self.rows_per_band)
+        bucket_keys = _fnv_band_keys(self._band_seeds, bands)
         
-        # Iterate through each band of the query signature
-        for band_idx in range(self.num_bands):
-
-            # Calculate start and end indices for the current band
-            start_index = band_idx * self.rows_per_band
-            end_index = start_index + self.rows_per_band
-            
-            # Extract band signature and convert to tuple
-            band_signature = tuple(query_signature[start_index:end_index])
-            
-            # Create bucket key using custom hash function
-            bucket_key = self.create_bucket_hash(band_idx, band_signature)
-            
-            # Add users from the matching bucket (if exists)
-            if bucket_key in self.buckets:
-                candidates.update(self.buckets[bucket_key])
+        # First pass: collect the users of the matching bucket of each band (if exists)
+        hits = [bucket for bucket in map(self.buckets.get, bucket_keys) if bucket]
+        
+        if not hits:
+            return []
+        
+        # Second pass: concatenate all hits once and deduplicate them in C
+        candidates = np.unique(np.concatenate(hits))
         
         # Remove the query user from candidates to avoid self-matching
-        candidates.discard(query_user_id)
+        return candidates[candidates != query_user_id].tolist()
+    
+    def query_with_similarity(self, query_signature: list, query_user_id: int):
+        """
+        Find candidate similar users and rank them by estimated Jaccard similarity.
         
-        return list(candidates)
+        The candidates' signatures are gathered from the stacked signatures kept by 
+        build_buckets and compared with the query signature in a single NumPy call.
+        
+        Args:
+            query_signature (list): Signature array of the query user
+            query_user_id (int): ID of the user making the query
+        
+        Returns:
+            list: (user ID, estimated similarity) pairs sorted by decreasing similarity
+        """
+        if self._signature_matrix is None:
+            raise ValueError("query_with_similarity needs the signatures kept by build_buckets")
+        
+        candidates = self.query(query_signature, query_user_id)
+        if not candidates:
+            return []
+        
+        # Fraction of equal hash values between the query and every candidate
+        candidate_signatures = self._signature_matrix[[self._user_rows[user_id] for user_id in candidates]]
+        similarities = MinHash.jaccard_similarity_batch(candidate_signatures, query_signature)
+        
+        order = np.argsort(-similarities, kind="stable")
+        return [(candidates[i], float(similarities[i])) for i in order]
     
     def view_buckets(self, num_buckets: int = 10):
         """
@@ -119,10 +244,15 @@ class LSH:
         Returns:
             None
         """
+        # Copy the bucket keys only once per build_buckets, not on every call
+        if self._bucket_keys is None:
+            self._bucket_keys = list(self.buckets)
+        
         # Select random bucket IDs
-        random_bucket_ids = random.sample(list(self.buckets.keys()), num_buckets)
+        random_bucket_ids = random.sample(self._bucket_keys, min(num_buckets, len(self._bucket_keys)))
 
         # Display the selected random buckets
-        for bucket_id in random_bucket_ids:
-            similar_users = self.buckets[bucket_id]
-            print(f"Bucket {bucket_id}: {similar_users}")
\ No newline at end of file
+        for bucket_key in random_bucket_ids:
+            similar_users = self.buckets[bucket_key]
+            # Format the key as a readable LSH-NNNNNN code
+            print(f"Bucket LSH-{bucket_key % 1000000:06d}: {similar_users}")
\ No newline at end of file
@@ -1,24 +1,10 @@
 import numpy as np
 import pandas as pd
-from sklearn.metrics import pairwise_distances
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-
-def next_prime(n):
-    """Find the next prime number greater than n."""
-    def is_prime(k):
-        if k < 2:
-            return False
-        for i in range(2, int(k**0.5) + 1):
-            if k % i == 0:
-                return False
-        return True
-    
-    prime = n + 1
-    while not is_prime(prime):
-        prime += 1
-    return prime
+# Prime search and MinHash signature generation are shared with the LSH workflow
+from libs.LSH import next_prime, generate_minhash_signatures
 
 
 def create_characteristic_matrix(ratings, all_movies, user_movies):
@@ -36,27 +22,6 @@ def create_characteristic_matrix(ratings, all_movies, user_movies):
     return characteristic_matrix
 
 
-def generate_minhash_signatures(characteristic_matrix, n_hashes):
-    """Generate MinHash signatures for the characteristic matrix."""
-    n_movies, n_users = characteristic_matrix.shape
-
-    # Generate random hash parameters
-    hash_params = [(np.random.randint(1, n_movies), np.random.randint(0, n_movies)) for _ in range(n_hashes)]
-    mod_prime = next_prime(n_movies)
-
-    # Initialize the signature matrix with infinity
-    signature_matrix = np.full((n_hashes, n_users), np.inf)
-
-    # Compute MinHash signatures
-    for row in range(n_movies):
-        hashes = [(a * row + b) % mod_prime for a, b in hash_params]
-        for col in range(n_users):
-            if characteristic_matrix[row, col] == 1:
-                signature_matrix[:, col] = np.minimum(signature_matrix[:, col], hashes)
-
-    return signature_matrix
-
-
 def compute_jaccard_similarity(signature_matrix, user1_idx, user2_idx):
     """Compute estimated Jaccard similarity between two users."""
     user1 = signature_matrix[:, user1_idx]
@@ -64,15 +29,31 @@ def compute_jaccard_similarity(signature_matrix, user1_idx, user2_idx):
     return np.mean(user1 == user2)
 
 
-def compute_similarities(signature_matrix):
+def compute_similarities(signature_matrix, block_size=None):
     """Compute pairwise similarity matrix for all users."""
-    return 1 - pairwise_distances(signature_matrix.T, metric="hamming")
+    n_hashes, n_users = signature_matrix.shape
+    signatures = signature_matrix.T.astype(np.int32)  # (n_users, n_hashes)
+    similarities = np.empty((n_users, n_users), dtype=np.float32)
+
+    # Keep the (block_size, n_users, n_hashes) boolean temporary around 64 MB
+    if block_size is None:
+        block_size = max(1, (1 << 26) // max(1, n_users * n_hashes))
+
+    # Similarity is the fraction of hash functions on which two users agree
+    for start in range(0, n_users, block_size):
+        block = signatures[start:start + block_size, None, :] == signatures[None, :, :]
+        similarities[start:start + block_size] = block.sum(axis=2, dtype=np.int32) / n_hashes
+
+    return similarities
 
 
 def recommend_movies(similarities, user_movies, target_user_idx, top_n=5):
     """Recommend movies for a target user based on similar users."""
-    # Find the most similar users
-    similar_users = np.argsort(similarities[target_user_idx])[-(top_n + 1):-1]
+    # Find the most similar users: partially sort the top_n + 1 scores, then drop the best one (the user itself)
+    row = similarities[target_user_idx]
+    k = min(top_n + 1, len(row))
+    top = np.argpartition(-row, k - 1)[:k]
+    similar_users = top[np.argsort(-row[top], kind="stable")][1:]
 
     # Aggregate recommended movies
     recommended_movies = set()
@@ -91,13 +72,15 @@ def plot_probability_curve(n=100, band_values=[5, 10, 20, 25, 50]):
     as a function of their similarity for different banding configurations.
     """
     s = np.linspace(0, 1, 100)  # Range of similarity values from 0 to 1
+    bands = np.asarray(band_values, dtype=int)
+    rows = n // bands  # Calculate rows per band
 
-    plt.figure(figsize=(10, 6))
+    # One column per banding configuration: shape (len(s), len(band_values))
+    probability = 1 - (1 - s[:, None]**rows)**bands
 
-    for b in band_values:
-        r = n // b  # Calculate rows per band
-        probability = 1 - (1 - s**r)**b
-        plt.plot(s, probability, label=f"$b = {b}, r = {r}$")
+    plt.figure(figsize=(10, 6))
+    for column, (b, r) in enumerate(zip(bands, rows)):
+        plt.plot(s, probability[:, column], label=f"$b = {b}, r = {r}$")
 
     plt.title(f"Probability for $n = {n}$ hash functions and different values of $b$")
     plt.xlabel("Similarity $s$")
@@ -164,15 +147,22 @@ def generate_minhash_signatures_with_interaction(interaction_sparse_matrix, n_ha
     n_movies, n_users = interaction_sparse_matrix.shape
     mod_prime = next_prime(n_movies)
 
-    # Initialize the signature matrix with infinity
-    signature_matrix = np.full((n_hashes, n_users), np.inf)
-
-    # Iterate through the non-zero entries in the sparse matrix
-    for row, col in zip(interaction_sparse_matrix.row, interaction_sparse_matrix.col):
-        # Compute hash values for the current row (movieId)
-        hash_values = [(a * row + b) % mod_prime for a, b in zip(a_values, b_values)]
-        # Update the signature matrix with the minimum hash values
-        signature_matrix[:, col] = np.minimum(signature_matrix[:, col], hash_values)
+    # Initialize the signature matrix with the largest int64
+    signature_matrix = np.full((n_hashes, n_users), np.iinfo(np.int64).max, dtype=np.int64)
+
+    # Hash only the rows (movieIds) that appear in the sparse matrix
+    a_values = np.asarray(a_values, dtype=np.int64)
+    b_values = np.asarray(b_values, dtype=np.int64)
+    rows = np.asarray(interaction_sparse_matrix.row, dtype=np.int64)
+    cols = np.asarray(interaction_sparse_matrix.col)
+
+    # Group the non-zero entries by column (userId) and take the minimum per user
+    order = np.argsort(cols, kind="stable")
+    rows, cols = rows[order], cols[order]
+    users, starts = np.unique(cols, return_index=True)
+    for user, user_rows in zip(users, np.split(rows, starts[1:])):
+        hash_values = (np.multiply.outer(a_values, user_rows) + b_values[:, None]) % mod_prime
+        signature_matrix[:, user] = hash_values.min(axis=1)
 
     return signature_matrix
 
@@ -1,6 +1,8 @@
+import random
+
+import numpy as np
 from pyspark.sql import functions as F
 from pyspark.sql.types import ArrayType, IntegerType
-import random
 
 
 class MinHashSpark:
@@ -18,6 +20,10 @@ class MinHashSpark:
         self.prime = prime
         self.hash_functions = self._generate_hash_functions()
 
+        # Coefficients as arrays, so a signature is computed with all hash functions at once
+        self._a = np.array([a for a, _ in self.hash_functions], dtype=np.int64)
+        self._b = np.array([b for _, b in self.hash_functions], dtype=np.int64)
+
     def _generate_hash_functions(self):
         """
         Generate random hash functions of the form h(x) = (a * x + b) % p.
@@ -33,12 +39,13 @@ class MinHashSpark:
         """
         Create a PySpark UDF to compute MinHash signatures for a list of movie IDs.
         """
+        a, b, prime = self._a, self._b, self.prime
+
         def compute_signature(movies):
-            signature = []
-            for a, b in self.hash_functions:
-                min_hash = min(((a * movie_id + b) % self.prime) for movie_id in movies)
-                signature.append(min_hash)
-            return signature
+            # Hash every movie with every hash function, then keep the minimum per hash function
+            movies = np.asarray(movies, dtype=np.int64)
+            hash_values = (np.multiply.outer(a, movies) + b[:, None]) % prime
+            return hash_values.min(axis=1).tolist()
 
         return F.udf(compute_signature, ArrayType(IntegerType()))
 
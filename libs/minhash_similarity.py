@@ -1,30 +1,84 @@
+import heapq
 import numpy as np
-import random 
+
+try:
+    from libs._minhash_numba import minhash_linear
+except ImportError:
+    minhash_linear = None
+
+# Mersenne prime 2**31 - 1: products of two values below it still fit in int64,
+# and reducing modulo it needs only shifts, masks and adds instead of a division
+MERSENNE_PRIME = (1 << 31) - 1
+
+# Modulus of the second hash in the universal family
+UNIVERSAL_PRIME = 104729
+
+
+def _mod_prime(values, prime):
+    """
+    Reduce non-negative int64 values (below 2**62) modulo prime.
+    For MERSENNE_PRIME uses x % p == (x & p) + (x >> 31) folding, which vectorizes.
+    """
+    if prime != MERSENNE_PRIME:
+        return values % prime
+    values = (values & MERSENNE_PRIME) + (values >> 31)
+    values = (values & MERSENNE_PRIME) + (values >> 31)
+    values[values >= MERSENNE_PRIME] -= MERSENNE_PRIME
+    return values
+
 
 class MinHash:
-    def __init__(self, n_hash_functions: int = 100, prime_number: int = 10513, type_function: str = 'linear'):
+    # Number of movies hashed at once by create_signature
+    chunk_size = 4096
+
+    def __init__(self, n_hash_functions: int = 100, prime_number: int = MERSENNE_PRIME, type_function: str = 'linear', bbit: int = 32):
         """
         Initialize MinHash with a specified number of hash functions.
         
         Args:
             n_hash_functions: Number of hash functions to use for creating signatures (default is 100)
-            prime: A higher prime number for the hash function (default is 10513)
+            prime: A higher prime number for the hash function, at most 2**31 - 1 so that the
+                   int64 hashing never overflows (default is the Mersenne prime 2**31 - 1)
             type_function: Type of hash function to use ('linear', 'universal', 'polynomial')
+            bbit: Number of low bits kept from each hash value, from 1 to 32 (default is 32).
+                  Signatures are stored as uint32, uint16 or uint8, whichever is the smallest that fits.
+                  Hash values are below the prime (at most 2**31 - 1), so bbit=32 keeps them whole.
         """
         if n_hash_functions <= 0:
             raise ValueError("Number of hash functions must be greater than 0")
         
+        if prime_number > MERSENNE_PRIME:
+            raise ValueError("prime_number must be at most 2**31 - 1")
+        
+        # Lowercase once, so that e.g. 'Linear' is accepted and no later call needs to normalize it
+        type_function = type_function.lower()
         if type_function not in ['linear', 'universal', 'polynomial']:
             raise ValueError("Invalid type_function. It must be one of 'linear', 'universal', 'polynomial'")
         
+        if not 1 <= bbit <= 32:
+            raise ValueError("bbit must be between 1 and 32")
+        
         self.n_hash_functions = n_hash_functions
         self.prime = prime_number
         self.type_function = type_function
+        self.bbit = bbit
+        self._bbit_mask = (1 << bbit) - 1
+        self._signature_dtype = np.uint8 if bbit <= 8 else np.uint16 if bbit <= 16 else np.uint32
 
         # Generate random coefficients for each hash function within the modulus range
-        self.a = [random.randint(1, self.prime - 1) for _ in range(n_hash_functions)]
-        self.b = [random.randint(0, self.prime - 1) for _ in range(n_hash_functions)]
-        self.coefficients = [[random.randint(1, self.prime - 1) for _ in range(3)] for _ in range(n_hash_functions)]  # For polynomial hash
+        self.a = np.random.randint(1, self.prime, size=n_hash_functions, dtype=np.int64)
+        self.b = np.random.randint(0, self.prime, size=n_hash_functions, dtype=np.int64)
+        self.coefficients = np.random.randint(1, self.prime, size=(n_hash_functions, 3), dtype=np.int64)  # For polynomial hash
+
+        # Resolve the hash family once instead of comparing strings on every call
+        self._hash_scalar, self._hash_impl = {
+            'linear': (self._linear, self._linear_vec),
+            'polynomial': (self._polynomial, self._polynomial_vec),
+            'universal': (self._universal, self._universal_vec),
+        }[self.type_function]
+
+        # Every hash value is below the modulus of its family, so it bounds the signature from above
+        self._hash_bound = UNIVERSAL_PRIME if self.type_function == 'universal' else self.prime
 
     def hash_function(self, x, a, b, i):
         """
@@ -39,25 +93,27 @@ class MinHash:
         Returns:
             int: Hashed value
         """
-        self.type_function= self.type_function.lower()
+        return self._hash_scalar(x, a, b, i)
 
-        if self.type_function in ('linear', 'l'):
-            return (a * x + b) % self.prime
-        
-        elif self.type_function in ('polynomial', 'p'):
-            coefficients = self.coefficients[i]
-            hash_value = sum(coefficient * (x ** exponent) for exponent, coefficient in enumerate(coefficients)) % self.prime
-            return hash_value
-        
-        elif self.type_function in ('universal', 'u'):
-            m = 104729  # A larger prime modulus
-            hash_value1 = (a * x + b) % self.prime # First hash function
-            hash_value2 = (a * hash_value1 + b) % m # Second hash function for double hashing
+    def _linear(self, x, a, b, i):
+        """Linear hash: (a * x + b) % prime."""
+        return (a * x + b) % self.prime
 
-            return (hash_value1 + hash_value2) % m # Combine both hash values to reduce collision probability
-        
-        else:
-            raise ValueError(f"Unknown hash function type: {self.type_function}")
+    def _polynomial(self, x, a, b, i):
+        """Polynomial hash: sum of coefficient * x**exponent, modulo prime, evaluated with Horner's rule."""
+        coefficients = self.coefficients[i].tolist()
+        hash_value = coefficients[-1]
+        for coefficient in reversed(coefficients[:-1]):
+            hash_value = (hash_value * x + coefficient) % self.prime
+        return hash_value
+
+    def _universal(self, x, a, b, i):
+        """Double hashing of a linear hash with a larger prime modulus."""
+        m = UNIVERSAL_PRIME  # Fixed modulus of the universal family, independent of self.prime
+        hash_value1 = (a * x + b) % self.prime # First hash function
+        hash_value2 = (a * hash_value1 + b) % m # Second hash function for double hashing
+
+        return (hash_value1 + hash_value2) % m # Combine both hash values to reduce collision probability
 
     def create_signature(self, movie_set):
         """
@@ -67,19 +123,48 @@ class MinHash:
             movie_set: Set of movie IDs
             
         Returns:
-            np.ndarray: MinHash signature (array of minimum hash values)
-        """
-        # Initialize signature array with infinity
-        signature = np.full(self.n_hash_functions, np.inf)
+            np.ndarray: MinHash signature (array of minimum hash values, truncated to bbit bits)
         
-        # For each movie ID, apply all hash functions
-        for movie_id in movie_set:
-            for i in range(self.n_hash_functions):
-                hash_value = self.hash_function(movie_id, self.a[i], self.b[i],i)
-                # Update the signature by taking the minimum hash value for each hash function
-                signature[i] = min(signature[i], hash_value)
-                
-        return signature.astype(int)
+        The signature of an empty set is the upper bound of the hash values. With bbit=32 no
+        real hash value reaches it, but with fewer bits its low bits can equal real hash values,
+        so empty sets are not distinguishable from non-empty ones.
+        """
+        movies = np.fromiter(movie_set, dtype=np.int64, count=len(movie_set))
+
+        # Initialize signature array with the upper bound of the hash values (kept as is for an empty set)
+        signature = np.full(self.n_hash_functions, self._hash_bound, dtype=np.int64)
+
+        # Linear hashes have a compiled kernel that fuses hashing and the running minimum
+        if minhash_linear is not None and self.type_function == 'linear':
+            minhash_linear(self.a, self.b, movies, self.prime, signature)
+
+        else:
+            # Hash the movies in chunks to bound the (n_hash_functions, chunk_size) temporary
+            for start in range(0, len(movies), self.chunk_size):
+                hash_values = self._hash_impl(movies[start:start + self.chunk_size])
+                # The signature keeps the minimum hash value for each hash function
+                np.minimum(signature, hash_values.min(axis=1), out=signature)
+
+        # b-bit MinHash: keep only the low bbit bits, stored in the narrowest unsigned dtype
+        return (signature & self._bbit_mask).astype(self._signature_dtype)
+
+    # Vectorized hash families: hash an int64 array of movie IDs with all hash functions at once
+    # and return an array of shape (n_hash_functions, len(movies))
+
+    def _linear_vec(self, movies):
+        return _mod_prime(np.multiply.outer(self.a, movies) + self.b[:, None], self.prime)
+
+    def _polynomial_vec(self, movies):
+        # Horner's rule, reducing after every step so that no product overflows int64
+        c = self.coefficients
+        hash_values = _mod_prime(np.multiply.outer(c[:, 2], movies) + c[:, 1, None], self.prime)
+        return _mod_prime(hash_values * movies + c[:, 0, None], self.prime)
+
+    def _universal_vec(self, movies):
+        m = UNIVERSAL_PRIME  # Fixed modulus of the universal family, independent of self.prime
+        hash_values1 = _mod_prime(np.multiply.outer(self.a, movies) + self.b[:, None], self.prime)
+        hash_values2 = (self.a[:, None] * hash_values1 + self.b[:, None]) % m
+        return (hash_values1 + hash_values2) % m
 
     def jaccard_similarity(self, signature1, signature2):
         """
@@ -98,34 +183,54 @@ class MinHash:
         # Jaccard similarity estimation
         return matching_hashes / self.n_hash_functions
 
+    @staticmethod
+    def jaccard_similarity_batch(candidates_matrix, query_signature):
+        """
+        Estimate Jaccard similarity between one MinHash signature and many others at once.
+        Also used by LSH.query_with_similarity to score its candidates.
+        
+        Args:
+            candidates_matrix: Signatures stacked row-wise, shape (n_candidates, n_hash_functions)
+            query_signature: MinHash signature to compare against every row
+        
+        Returns:
+            np.ndarray: Estimated Jaccard similarities (0-1), one per candidate
+        """
+        # Fraction of matching hash values of every candidate, in a single comparison
+        return np.mean(candidates_matrix == np.asarray(query_signature), axis=1)
 
+
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-def generate_signatures(user_movies: dict, num_hash_function: int,function_name: str):
+def generate_signatures(user_movies: dict, num_hash_function: int,function_name: str, n_jobs: int = None):
 
     minhash=MinHash(num_hash_function,type_function=function_name)
-     # Initialize an empty dictionary to store the MinHash signatures for each user.
-    signatures = {}
 
-    # Iterate over each user and their associated movie set in the `user_movies` dictionary.
-    # Use tqdm to display a progress bar for tracking the loop's progress.
+    # create_signature is pure NumPy, which releases the GIL, so users can be hashed in parallel threads.
+    # n_jobs is the number of worker threads (None lets the executor pick one per core).
+    user_ids = list(user_movies.keys())
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = executor.map(minhash.create_signature, user_movies.values())
+        # Use tqdm to display a progress bar for tracking the loop's progress.
+        signature_list = list(tqdm(results, desc="Generating Signatures", total=len(user_movies)))
 
-    for user_id, movies in tqdm(user_movies.items(), desc="Generating Signatures", total=len(user_movies)):
-        signatures[user_id] = minhash.create_signature(movies)   # Generate a MinHash signature for the current user's movie set and store it.
+    # Map each user to its MinHash signature, keeping the order of `user_movies`.
+    signatures = dict(zip(user_ids, signature_list))
     return signatures
 
-def exact_jaccard_similarity(sig1, sig2):
+def exact_jaccard_similarity(set1, set2):
     """
-    sig1 : the signature of the user 1
-    sig2 : the signature of the user 2
+    set1 : the set of movies rated by user 1
+    set2 : the set of movies rated by user 2
     """
-    intersection = len(sig1 & sig2)
-    union = len(sig1 | sig2)
+    intersection = len(set1 & set2)
+    union = len(set1) + len(set2) - intersection  # |A ∪ B| without building the union set
     return intersection / union # Return Jaccard similarity value between 0 and 1
 
 
 
-def compute_similarities(user_signatures, user_movies, max_results=10, similarity_threshold=0.6, hash_functions=100):
+def compute_similarities(user_signatures, user_movies, max_results=10, similarity_threshold=0.6, hash_functions=100, block_size=128):
     # Initialize a counter to track the number of similar user pairs above the threshold
     similar_users_count=0
     # Set a random seed for reproducibility of results
@@ -133,36 +238,44 @@ def compute_similarities(user_signatures, user_movies, max_results=10, similarit
     
     # Select 1000 random user IDs to compute similarities
     user_ids = np.random.choice(range(1, len(user_movies) + 1), 1000, replace=False)
+
+    # Freeze the movie sets of the selected users once for the exact Jaccard similarity
+    user_movies = {user_id: frozenset(user_movies[user_id]) for user_id in user_ids}
     
     # Initialize dictionaries to store similarities and losses
     similarities, losses = {}, []
-    
-    for i in range(len(user_ids)):
-        for j in range(i + 1, len(user_ids)):
-        
-            # Create MinHash instance for each comparison
-            minhash = MinHash(n_hash_functions=hash_functions)
-            
-            # Estimate Jaccard similarity using MinHash signatures
-            est_sim = minhash.jaccard_similarity(user_signatures[user_ids[i]], user_signatures[user_ids[j]])
-            
-            # Filter pairs above certain similarity threshold
-            if est_sim > similarity_threshold:
-
-                similar_users_count += 1  # Increment the counter for similar users
-
-                # Compute exact Jaccard similarity
-                exact_sim = exact_jaccard_similarity(user_movies[user_ids[i]], user_movies[user_ids[j]])
-                
-                # Calculate loss between estimated and exact similarities
-                loss = abs(est_sim - exact_sim)
-                losses.append(loss)
-                
-                # Store similarity information
-                similarities[(user_ids[i], user_ids[j])] = (est_sim, exact_sim, loss)
-    
-    # Sort similarities by estimated similarity in descending order
-    sorted_sims = sorted(similarities.items(), key=lambda x: x[1][0], reverse=True)[:max_results]
+
+    # Stack the signatures of the selected users once: shape (n_users, hash_functions)
+    signatures = np.vstack([user_signatures[user_id] for user_id in user_ids]).astype(np.int32)
+    n_users = len(user_ids)
+
+    # Compare blocks of users against all the others to bound the size of the boolean tensor
+    for start in range(0, n_users, block_size):
+        # Estimate Jaccard similarity using MinHash signatures
+        matches = (signatures[start:start + block_size, None, :] == signatures[None, :, :]).sum(axis=2)
+        est_block = matches / hash_functions
+
+        # Filter pairs (i < j) above certain similarity threshold
+        for i, j in zip(*np.nonzero(est_block > similarity_threshold)):
+            i += start
+            if j <= i:
+                continue
+            est_sim = est_block[i - start, j]
+
+            similar_users_count += 1  # Increment the counter for similar users
+
+            # Compute exact Jaccard similarity
+            exact_sim = exact_jaccard_similarity(user_movies[user_ids[i]], user_movies[user_ids[j]])
+
+            # Calculate loss between estimated and exact similarities
+            loss = abs(est_sim - exact_sim)
+            losses.append(loss)
+
+            # Store similarity information
+            similarities[(user_ids[i], user_ids[j])] = (est_sim, exact_sim, loss)
+
+    # Select the top pairs by estimated similarity in descending order (partial sort, same order as sorted)
+    sorted_sims = heapq.nlargest(max_results, similarities.items(), key=lambda x: x[1][0])
     
     # Print details of top similar user pairs
     for (user1, user2), (est_sim, exact_sim, loss) in sorted_sims: